@@ -4,6 +4,7 @@ import time
 from flask import Flask, render_template, request, jsonify, Response, current_app
 from flask_cors import CORS
 import json
+from collections import defaultdict
 from database import db, init_db
 from session_evaluator import SessionEvaluator
 from thread_manager import ThreadManager
@@ -227,13 +228,10 @@ def vapi_chat():
                                 assistant = OpenAIAssistant()
                                 conversation = Conversation.query.filter_by(session_id=session_id).first()
                                 if conversation and assistant._can_run_evaluation(session_id, conversation.id):
-                                    logger.info(f"Running evaluation for completed session {session_id}")
+                                    # Interim evaluations are not urgent, so they go through the Batch API
+                                    logger.info(f"Queueing interim evaluation for session {session_id}")
                                     evaluator = SessionEvaluator()
-                                    result = evaluator.analyze_conversation(session_id)
-                                    if result['success']:
-                                        logger.info(f"Successfully evaluated session {session_id}")
-                                    else:
-                                        logger.error(f"Failed to evaluate session {session_id}: {result.get('error')}")
+                                    evaluator.queue_interim(session_id)
                                 else:
                                     logger.debug(f"Skipping evaluation for session {session_id} - conditions not met")
                             except Exception as e:
@@ -303,6 +301,27 @@ def vapi_chat():
             "session_id": current_session
         }), 500
 
+INTERIM_BATCH_INTERVAL = 300  # Seconds between interim evaluation batch submissions
+
+def interim_batch_worker():
+    """Periodically submit queued interim evaluations, store finished batch results and purge
+    expired LLM cache entries"""
+    import gevent
+    while True:
+        gevent.sleep(INTERIM_BATCH_INTERVAL)
+        with app.app_context():
+            try:
+                evaluator = SessionEvaluator()
+                evaluator.submit_interim_batch()
+                stored = evaluator.collect_interim_batches()
+                if stored:
+                    logger.info(f"Stored {stored} interim evaluations from batch results")
+                purged = evaluator.purge_expired_cache()
+                if purged:
+                    logger.info(f"Purged {purged} expired LLM cache entries")
+            except Exception as e:
+                logger.error(f"Error in interim batch worker: {str(e)}", exc_info=True)
+
 @app.route('/stream', methods=['POST'])
 def stream():
     """SSE endpoint for streaming responses"""
@@ -374,13 +393,19 @@ def view_conversations():
         conversations = Conversation.query.order_by(Conversation.created_at.desc()).all()
         conversations_data = []
 
+        # Fetch every message's display columns in one query instead of one per conversation
+        messages_by_conversation = defaultdict(list)
+        for conversation_id, role, content, created_at in db.session.query(
+            Message.conversation_id, Message.role, Message.content, Message.created_at
+        ).order_by(Message.conversation_id, Message.created_at):
+            messages_by_conversation[conversation_id].append({
+                'role': role,
+                'content': content,
+                'created_at': created_at.strftime('%Y-%m-%d %H:%M:%S')
+            })
+
         for conv in conversations:
-            messages = Message.query.filter_by(conversation_id=conv.id).order_by(Message.created_at).all()
-            messages_data = [{
-                'role': msg.role,
-                'content': msg.content,
-                'created_at': msg.created_at.strftime('%Y-%m-%d %H:%M:%S')
-            } for msg in messages]
+            messages_data = messages_by_conversation.get(conv.id, [])
 
             conversations_data.append({
                 'id': conv.id,
@@ -426,7 +451,14 @@ def mark_pass_complete(session_id):
 def start_second_pass(session_id):
     """Initialize second interview pass"""
     try:
-        conversation = Conversation.query.filter_by(session_id=session_id).first()
+        # Fetch only the columns needed for the checks, with the person model joined in
+        conversation = db.session.query(
+            Conversation.id,
+            Conversation.first_pass_completed,
+            PersonModel.follow_up_questions
+        ).outerjoin(
+            PersonModel, PersonModel.conversation_id == Conversation.id
+        ).filter(Conversation.session_id == session_id).first()
         if not conversation:
             return jsonify({
                 "status": "error",
@@ -439,14 +471,13 @@ def start_second_pass(session_id):
                 "message": "First pass must be completed before starting second pass"
             }), 400
 
-        person_model = PersonModel.query.filter_by(conversation_id=conversation.id).first()
-        if not person_model or not person_model.follow_up_questions:
+        if not conversation.follow_up_questions:
             return jsonify({
                 "status": "error",
                 "message": "No follow-up questions available. Please run evaluation first."
             }), 400
 
-        conversation.current_pass = 2
+        Conversation.query.filter_by(id=conversation.id).update({"current_pass": 2})
         db.session.commit()
 
         # Update the current session to the selected conversation
@@ -491,6 +522,25 @@ def view_evaluation_results(session_id):
         logger.error(f"Error viewing evaluation results: {str(e)}")
         return str(e), 500
 
+@app.route('/api/evaluate/<session_id>/stream', methods=['POST'])
+def stream_evaluation(session_id):
+    """SSE endpoint that runs an interim evaluation, reporting each section as it is analyzed"""
+    def generate():
+        with app.app_context():
+            for event in SessionEvaluator().analyze_conversation_stream(session_id):
+                yield f"data: {json.dumps(event)}\n\n"
+
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'Connection': 'keep-alive',
+            'X-Accel-Buffering': 'no',
+            'X-Session-ID': session_id
+        }
+    )
+
 @app.route('/api/thread/info/<session_id>', methods=['GET'])
 def get_thread_info(session_id):
     """Get information about a session's thread."""
@@ -1,5 +1,6 @@
 import os
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect, text
 import logging
 
 logger = logging.getLogger(__name__)
@@ -26,6 +27,29 @@ def init_db(app):
 
             logger.info("Creating database tables...")
             db.create_all()
+
+            # create_all skips tables that already exist, so add any nullable
+            # columns and indexes declared since those tables were created
+            inspector = inspect(db.engine)
+            for table in db.metadata.sorted_tables:
+                existing = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing and column.nullable:
+                        logger.info(f"Adding column {table.name}.{column.name}")
+                        with db.engine.begin() as connection:
+                            connection.execute(text(
+                                f"ALTER TABLE {table.name} ADD COLUMN {column.name} "
+                                f"{column.type.compile(dialect=db.engine.dialect)}"
+                            ))
+
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    try:
+                        index.create(bind=db.engine, checkfirst=True)
+                    except Exception:
+                        logger.error(f"Could not create index {index.name}; a unique index fails on existing "
+                                     f"duplicate rows, which dedupe_person_models.py removes for person_models")
+                        raise
             logger.info("Database initialization completed successfully")
 
     except Exception as e:
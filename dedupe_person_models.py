@@ -0,0 +1,57 @@
+"""One-off cleanup of duplicate person models.
+
+Older releases wrote person models with a select-then-insert, which could race into
+several rows for one conversation. Those duplicates block the unique index on
+person_models.conversation_id, so run this once before starting the app:
+
+    python dedupe_person_models.py [--dry-run]
+"""
+import logging
+import os
+import sys
+from flask import Flask
+from sqlalchemy import func
+from database import db
+from models import PersonModel
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def dedupe_person_models(dry_run=False):
+    """Keep the most recently updated person model per conversation and delete the others.
+
+    Returns the IDs of the removed rows, or of the rows that would be removed on a dry run.
+    """
+    duplicated = db.session.query(PersonModel.conversation_id)\
+        .group_by(PersonModel.conversation_id)\
+        .having(func.count() > 1)
+    rows = db.session.query(PersonModel.id, PersonModel.conversation_id)\
+        .filter(PersonModel.conversation_id.in_(duplicated))\
+        .order_by(PersonModel.conversation_id, PersonModel.updated_at.desc(), PersonModel.id.desc())\
+        .all()
+
+    kept = set()
+    removed = []
+    for model_id, conversation_id in rows:
+        if conversation_id in kept:
+            logger.info(f"Removing person model {model_id} for conversation {conversation_id}")
+            removed.append(model_id)
+        else:
+            logger.info(f"Keeping person model {model_id} for conversation {conversation_id}")
+            kept.add(conversation_id)
+
+    if removed and not dry_run:
+        PersonModel.query.filter(PersonModel.id.in_(removed)).delete(synchronize_session=False)
+        db.session.commit()
+    return removed
+
+if __name__ == "__main__":
+    # Deliberately not the app's init_db, which would fail on the index this script unblocks
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    db.init_app(app)
+
+    dry_run = "--dry-run" in sys.argv[1:]
+    with app.app_context():
+        removed = dedupe_person_models(dry_run)
+    logger.info(f"{'Would remove' if dry_run else 'Removed'} {len(removed)} duplicate person models: {removed}")
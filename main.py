@@ -3,8 +3,9 @@ import monkey  # noqa: F401 - Import monkey patching first
 import os
 import logging
 import signal
+import gevent
 from gevent.pywsgi import WSGIServer
-from app import app
+from app import app, interim_batch_worker
 
 if __name__ == "__main__":
     # Configure detailed logging
@@ -33,6 +34,9 @@ if __name__ == "__main__":
         signal.signal(signal.SIGTERM, signal_handler)
         signal.signal(signal.SIGINT, signal_handler)
 
+        # Submit and collect interim evaluations through the Batch API in the background
+        gevent.spawn(interim_batch_worker)
+
         logger.info("Server initialization complete, starting WSGI server")
         http_server.serve_forever()
 
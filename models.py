@@ -7,7 +7,8 @@ class Conversation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, nullable=False)
-    messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
+    messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan',
+                               order_by='Message.created_at')
     interview_data = db.relationship('InterviewData', backref='conversation', uselist=False, cascade='all, delete-orphan')
     session_id = db.Column(db.String(100), unique=True)  # Added for session tracking
     person_model = db.relationship('PersonModel', backref='conversation', uselist=False, cascade='all, delete-orphan')
@@ -17,6 +18,10 @@ class Conversation(db.Model):
 
 class Message(db.Model):
     __tablename__ = 'messages'
+    __table_args__ = (
+        # History reads filter by conversation and order by creation time
+        db.Index('ix_messages_conversation_created', 'conversation_id', 'created_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
@@ -24,6 +29,23 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
+def store_messages(conversation_id, messages):
+    """Persist a turn's (role, content, created_at) messages in a single commit.
+
+    The rows are plain log entries, so they skip the ORM unit of work.
+    """
+    try:
+        db.session.bulk_insert_mappings(Message, [{
+            "conversation_id": conversation_id,
+            "role": role,
+            "content": content,
+            "created_at": created_at
+        } for role, content, created_at in messages])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
 class InterviewData(db.Model):
     __tablename__ = 'interview_data'
 
@@ -74,6 +96,10 @@ class InterviewData(db.Model):
 class PersonModel(db.Model):
     """Stores structured person model data extracted from interviews"""
     __tablename__ = 'person_models'
+    __table_args__ = (
+        # One model per conversation; also the conflict target for upserts
+        db.Index('ix_person_models_conversation_id', 'conversation_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
@@ -83,6 +109,7 @@ class PersonModel(db.Model):
     missing_topics = db.Column(db.JSON, default=list)  # Stores identified missing details
     follow_up_questions = db.Column(db.JSON, default=list)  # Suggested follow-ups
     debug_info = db.Column(db.JSON, default=dict)  # Stores debug information
+    analyzed_through = db.Column(db.DateTime)  # Creation time of the last message analyzed
 
 class SessionThread(db.Model):
     """Stores OpenAI thread information for session management"""
@@ -99,4 +126,29 @@ class SessionThread(db.Model):
     def touch(self):
         """Update the last activity timestamp"""
         self.last_activity = datetime.utcnow()
-        self.updated_at = datetime.utcnow()
\ No newline at end of file
+        self.updated_at = datetime.utcnow()
+
+class LLMCache(db.Model):
+    """Caches parsed LLM responses keyed by a hash of the request"""
+    __tablename__ = 'llm_cache'
+
+    key = db.Column(db.String(64), primary_key=True)  # SHA-256 of model and messages
+    response = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class InterimEvaluation(db.Model):
+    """Interim evaluation requests queued for, or submitted to, the OpenAI Batch API"""
+    __tablename__ = 'interim_evaluations'
+    __table_args__ = (
+        # The batch worker reads the queue and each submitted batch by batch ID
+        db.Index('ix_interim_evaluations_batch_id', 'batch_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.String(100), nullable=False)
+    history_length = db.Column(db.Integer, nullable=False)  # Messages in the analyzed snapshot
+    messages = db.Column(db.JSON, nullable=False)  # Extraction request messages for the snapshot
+    analyzed_through = db.Column(db.DateTime)  # Creation time of the last message in the snapshot
+    batch_id = db.Column(db.String(100))  # Set once submitted; NULL while queued
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
@@ -1,25 +1,95 @@
 import os
+import re
 import logging
 import json
-from openai import OpenAI
+from openai import NotFoundError
 from flask import current_app
-from models import Message, Conversation, PersonModel
+from sqlalchemy import select, func
+from sqlalchemy.orm import joinedload
+from models import Message, Conversation, PersonModel, store_messages
 from database import db
+from openai_client import get_openai_client
 import time
+from datetime import datetime
+import gevent
 from session_evaluator import SessionEvaluator
-from threading import Lock
+from thread_manager import ThreadManager
 
 logger = logging.getLogger(__name__)
 
+# Evaluations running in the background, keyed by session ID
+_pending_evaluations = {}
+
+# Trigger phrases for special interview commands
+EVALUATION_PHRASES = (
+    "evaluate interview",
+    "run evaluation",
+    "analyze responses",
+    "check my answers",
+    "evaluate session",
+    "assess interview",
+)
+
+SECOND_PASS_PHRASES = (
+    "start second interview",
+    "begin second pass",
+    "start follow-up interview",
+    "begin second interview phase",
+    "proceed with second interview",
+    "start second phase questions",
+    "let's do the follow up",
+    "ready for follow up",
+    "continue with follow up",
+    "move to second interview",
+)
+
+COMPLETION_PHRASES = (
+    "mark interview complete",
+    "complete first interview",
+    "end first interview",
+    "finish first pass",
+    "mark first pass complete",
+    "first interview done",
+    "we can move on",
+    "ready for second pass",
+    "done with first interview",
+)
+
+END_INTERVIEW_PHRASES = (
+    "end interview",
+    "finish interview",
+    "conclude interview",
+    "that's all",
+    "we're done",
+    "wrap up",
+)
+
+
+def _compile_phrases(phrases):
+    """Compile trigger phrases into a single case-insensitive pattern"""
+    return re.compile("|".join(map(re.escape, phrases)), re.IGNORECASE)
+
+
+_EVALUATION_RE = _compile_phrases(EVALUATION_PHRASES)
+_SECOND_PASS_RE = _compile_phrases(SECOND_PASS_PHRASES)
+_COMPLETION_RE = _compile_phrases(COMPLETION_PHRASES)
+_END_INTERVIEW_RE = _compile_phrases(END_INTERVIEW_PHRASES)
+
+# Command intents in the order stream_response checks them, matched in one scan
+INTENT_PRIORITY = ('completion', 'second_pass', 'evaluation')
+_INTENT_RE = re.compile("|".join(
+    f"(?P<{intent}>{'|'.join(map(re.escape, phrases))})"
+    for intent, phrases in zip(INTENT_PRIORITY, (COMPLETION_PHRASES, SECOND_PASS_PHRASES, EVALUATION_PHRASES))
+), re.IGNORECASE)
+
 class OpenAIAssistant:
     def __init__(self):
         try:
-            self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+            self.client = get_openai_client()
             self.assistant_id = os.environ.get("OPENAI_ASSISTANT_ID")
             self.evaluator = SessionEvaluator()
-            self._thread_cache = {}  # Session ID to Thread ID mapping
-            self._cache_lock = Lock()  # Thread safety for cache operations
             self._message_batch_size = 10  # Number of messages to include in context
+            self._response_timeout = 120  # Seconds to wait on a stalled response stream
             self._min_messages_for_eval = 5  # Minimum messages before evaluation
             self._eval_cooldown = 300  # 5 minutes between evaluations
             self._last_eval_time = {}  # Track last evaluation time per session
@@ -30,48 +100,23 @@ class OpenAIAssistant:
             logger.error(f"Failed to initialize OpenAI client: {str(e)}", exc_info=True)
             raise
 
+    def classify_intent(self, message):
+        """Return the command intent of a user message ('completion', 'second_pass',
+        'evaluation'), or None for a normal message"""
+        found = {match.lastgroup for match in _INTENT_RE.finditer(message)}
+        return next((intent for intent in INTENT_PRIORITY if intent in found), None)
+
     def detect_evaluation_trigger(self, message):
         """Check if user message requests evaluation"""
-        trigger_phrases = [
-            "evaluate interview",
-            "run evaluation",
-            "analyze responses",
-            "check my answers",
-            "evaluate session",
-            "assess interview"
-        ]
-        return any(phrase in message.lower() for phrase in trigger_phrases)
+        return bool(_EVALUATION_RE.search(message))
 
     def detect_second_pass_trigger(self, message):
         """Check if user message indicates starting second pass"""
-        trigger_phrases = [
-            "start second interview",
-            "begin second pass",
-            "start follow-up interview",
-            "begin second interview phase",
-            "proceed with second interview",
-            "start second phase questions",
-            "let's do the follow up",
-            "ready for follow up",
-            "continue with follow up",
-            "move to second interview"
-        ]
-        return any(phrase in message.lower() for phrase in trigger_phrases)
+        return bool(_SECOND_PASS_RE.search(message))
 
     def detect_completion_trigger(self, message):
         """Check if user message indicates completing first pass"""
-        trigger_phrases = [
-            "mark interview complete",
-            "complete first interview",
-            "end first interview",
-            "finish first pass",
-            "mark first pass complete",
-            "first interview done",
-            "we can move on",
-            "ready for second pass",
-            "done with first interview"
-        ]
-        return any(phrase in message.lower() for phrase in trigger_phrases)
+        return bool(_COMPLETION_RE.search(message))
 
     def handle_completion_trigger(self, conversation_id):
         """Handle marking the first interview pass as complete"""
@@ -123,109 +168,76 @@ class OpenAIAssistant:
                     raise ValueError("No session ID provided")
 
                 # Check for special commands before creating/accessing thread
-                if self.detect_completion_trigger(user_message):
-                    response = self.handle_completion_trigger(conversation.id)
-                    if isinstance(response, dict):
-                        yield response
-                    else:
-                        yield {"type": "text", "content": response}
-                    return
-
-                elif self.detect_second_pass_trigger(user_message):
-                    response = self.handle_second_pass_transition(conversation.id)
-                    if isinstance(response, dict):
-                        yield response
+                intent = self.classify_intent(user_message)
+                if intent:
+                    if intent == 'completion':
+                        response = self.handle_completion_trigger(conversation.id)
+                    elif intent == 'second_pass':
+                        response = self.handle_second_pass_transition(conversation.id)
                     else:
-                        yield {"type": "text", "content": response}
-                    return
+                        response = self.handle_evaluation_trigger(conversation.id, conversation.session_id)
 
-                elif self.detect_evaluation_trigger(user_message):
-                    response = self.handle_evaluation_trigger(conversation.id, conversation.session_id)
                     if isinstance(response, dict):
                         yield response
                     else:
                         yield {"type": "text", "content": response}
                     return
 
-                # Continue with normal message processing...
-                thread_id = self._get_or_create_thread(session_id)
+                # Continue with normal message processing on the session's
+                # persistent thread; history is only replayed into new threads
+                def load_history():
+                    return self._load_recent_messages(conversation.id, self._message_batch_size)
 
-                # Add message to database
-                message = Message(
-                    conversation_id=conversation.id,
-                    role='user',
-                    content=user_message
-                )
-                db.session.add(message)
-                db.session.commit()
-
-                # Load recent message history
-                recent_messages = self._load_recent_messages(conversation.id, self._message_batch_size)
-
-                # Add messages to thread efficiently
-                for msg in recent_messages[-self._message_batch_size:]:  # Only latest messages
-                    self.client.beta.threads.messages.create(
-                        thread_id=thread_id,
-                        role=msg["role"],
-                        content=msg["content"]
-                    )
-
-                # Create and monitor run with optimized polling
-                run = self.client.beta.threads.runs.create(
-                    thread_id=thread_id,
-                    assistant_id=self.assistant_id
-                )
-
-                poll_interval = 0.5
-                max_polls = 60
-                polls = 0
-
-                while polls < max_polls:
-                    try:
-                        run_status = self.client.beta.threads.runs.retrieve(
-                            thread_id=thread_id,
-                            run_id=run.id
-                        )
-
-                        if run_status.status == 'completed':
-                            messages = self.client.beta.threads.messages.list(
-                                thread_id=thread_id,
-                                limit=1  # Only get latest message
-                            )
-
-                            for msg in messages.data:
-                                if msg.role == "assistant":
-                                    content = msg.content[0].text.value if hasattr(msg.content[0], 'text') else str(msg.content[0])
-
-                                    # Store response in database
-                                    assistant_message = Message(
-                                        conversation_id=conversation.id,
-                                        role='assistant',
-                                        content=content
-                                    )
-                                    db.session.add(assistant_message)
-                                    db.session.commit()
-
-                                    yield content
-                                    return
-
-                        elif run_status.status in ['failed', 'cancelled', 'expired']:
-                            error_msg = f"Assistant run failed with status: {run_status.status}"
+                thread_id = ThreadManager.get_or_create_thread(session_id, seed_messages=load_history)
+                try:
+                    run_stream = self._create_run(thread_id, user_message)
+                except NotFoundError:
+                    logger.info(f"Thread {thread_id} no longer exists for session {session_id}, replaying history")
+                    ThreadManager.deactivate_thread(session_id)
+                    thread_id = ThreadManager.get_or_create_thread(session_id, seed_messages=load_history)
+                    run_stream = self._create_run(thread_id, user_message)
+
+                # Messages for this turn are stored together once the run finishes
+                turn_messages = [('user', user_message, datetime.utcnow())]
+                response_parts = []
+                run_id = None
+                run_ended = False
+
+                # Yield text deltas as the assistant generates them
+                try:
+                    for event in run_stream:
+                        if event.event == 'thread.run.created':
+                            run_id = event.data.id
+
+                        elif event.event == 'thread.message.delta':
+                            for block in event.data.delta.content or []:
+                                if block.type == 'text' and block.text and block.text.value:
+                                    response_parts.append(block.text.value)
+                                    yield block.text.value
+
+                        elif event.event in ('thread.run.failed', 'thread.run.cancelled', 'thread.run.expired',
+                                             'thread.run.incomplete'):
+                            run_ended = True
+                            error_msg = f"Assistant run failed with status: {event.data.status}"
                             logger.error(error_msg)
                             yield error_msg
                             return
 
-                        time.sleep(poll_interval)
-                        polls += 1
-                        poll_interval = min(poll_interval * 1.5, 2.0)  # Progressive backoff
+                    run_ended = True
+                    if response_parts:
+                        turn_messages.append(('assistant', ''.join(response_parts), datetime.utcnow()))
 
-                    except Exception as e:
-                        logger.error(f"Error in run status check: {str(e)}", exc_info=True)
-                        yield f"Error processing response: {str(e)}"
-                        return
+                except Exception as e:
+                    logger.error(f"Error while streaming run: {str(e)}", exc_info=True)
+                    yield f"Error processing response: {str(e)}"
+                    return
 
-                yield "Response timeout exceeded"
-                return
+                finally:
+                    # A run left active on the persistent thread would reject the next turn's run
+                    if run_id and not run_ended:
+                        self._cancel_run(thread_id, run_id)
+                    # Keep the user message even when the run fails or the consumer closes the stream
+                    store_messages(conversation.id, turn_messages)
 
         except Exception as e:
             error_msg = f"Error in OpenAI Assistant: {str(e)}"
@@ -233,44 +245,87 @@ class OpenAIAssistant:
             yield error_msg
 
     def handle_evaluation_trigger(self, conversation_id, session_id):
-        """Process evaluation request with improved timing checks"""
+        """Start an evaluation in the background so the chat turn returns immediately"""
         try:
+            pending = _pending_evaluations.get(session_id)
+            if pending and not pending.ready():
+                return ("I'm still analyzing our conversation. Once the evaluation finishes, the first "
+                       "interview pass will be marked as complete and you can say 'start second interview'.")
+
+            # Reuse an existing evaluation that already covers every message and produced
+            # questions, probing only its question count rather than loading the JSON columns
+            last_message_at = select(func.max(Message.created_at))\
+                .where(Message.conversation_id == conversation_id)\
+                .scalar_subquery()
+            question_count = func.json_array_length(PersonModel.follow_up_questions)
+            current = db.session.query(question_count)\
+                .filter(PersonModel.conversation_id == conversation_id,
+                        PersonModel.analyzed_through >= last_message_at,
+                        question_count > 0)\
+                .first()
+            if current:
+                Conversation.query.filter_by(id=conversation_id).update({"first_pass_completed": True})
+                db.session.commit()
+                return (
+                    f"I've already analyzed our conversation up to this point and prepared {current[0]} "
+                    "follow-up questions. The first interview pass has been marked as complete. "
+                    "When you're ready to continue with the follow-up interview, just say 'start second interview' "
+                    "or use the button on the conversations page."
+                )
+
             # Check if evaluation is appropriate
             if not self._can_run_evaluation(session_id, conversation_id):
                 return ("I'd like to gather a bit more context before conducting an evaluation. "
                        "Let's continue with our conversation and I'll analyze it once we have "
                        "more substantial information to work with.")
 
-            result = self.evaluator.analyze_conversation(session_id)
+            app = current_app._get_current_object()
+            _pending_evaluations[session_id] = gevent.spawn(
+                self._run_evaluation, app, conversation_id, session_id
+            )
 
-            if result['success']:
-                # Update evaluation timestamp
-                self._last_eval_time[session_id] = time.time()
-
-                # Automatically mark first pass as complete when evaluation succeeds
-                conversation = Conversation.query.get(conversation_id)
-                if conversation:
-                    conversation.first_pass_completed = True
-                    db.session.commit()
-
-                return (
-                    "I've analyzed our conversation and identified several areas to explore further. "
-                    "The first interview pass has been marked as complete. "
-                    "When you're ready to continue with the follow-up interview, just say 'start second interview' "
-                    "or use the button on the conversations page."
-                )
-            else:
-                logger.error(f"Evaluation failed: {result['error']}")
-                return "I apologize, but I encountered an error while evaluating our conversation. Would you like to continue with the standard interview format?"
+            return (
+                "I've started analyzing our conversation to identify areas to explore further. "
+                "The first interview pass will be marked as complete once the evaluation finishes. "
+                "When you're ready to continue with the follow-up interview, just say 'start second interview' "
+                "or use the button on the conversations page."
+            )
 
         except Exception as e:
             logger.error(f"Error in handle_evaluation_trigger: {str(e)}", exc_info=True)
             return "I encountered an error while trying to evaluate our conversation. Would you like to continue with the standard interview format?"
 
+    def _run_evaluation(self, app, conversation_id, session_id):
+        """Run an evaluation in its own app context and mark the first pass complete on success"""
+        with app.app_context():
+            try:
+                result = self.evaluator.analyze_conversation(session_id)
+
+                if result['success']:
+                    # Update evaluation timestamp
+                    self._last_eval_time[session_id] = time.time()
+
+                    # Automatically mark first pass as complete when evaluation succeeds
+                    conversation = Conversation.query.get(conversation_id)
+                    if conversation:
+                        conversation.first_pass_completed = True
+                        db.session.commit()
+                    logger.info(f"Background evaluation completed for session {session_id}")
+                else:
+                    logger.error(f"Evaluation failed: {result['error']}")
+
+            except Exception as e:
+                logger.error(f"Error in background evaluation: {str(e)}", exc_info=True)
+            finally:
+                _pending_evaluations.pop(session_id, None)
+
     def handle_second_pass_transition(self, conversation_id):
         """Handle the transition to second pass interview"""
         try:
-            conversation = Conversation.query.get(conversation_id)
+            # Load the person model in the same round-trip as the conversation
+            conversation = Conversation.query.options(
+                joinedload(Conversation.person_model)
+            ).get(conversation_id)
             if not conversation:
                 return "Unable to find the conversation."
 
@@ -279,54 +334,56 @@ class OpenAIAssistant:
                        "before we can proceed with follow-up questions. Would you like "
                        "to complete the current interview first?")
 
-            person_model = PersonModel.query.filter_by(conversation_id=conversation.id).first()
-            if not person_model or not person_model.follow_up_questions:
+            # Read the questions once, before the commit expires the loaded row
+            person_model = conversation.person_model
+            questions = person_model.follow_up_questions if person_model else None
+            if not questions:
                 return ("I don't have any follow-up questions prepared yet. "
                        "Let's evaluate your responses first by saying 'evaluate interview'.")
+            first_question = questions[0]
 
             conversation.current_pass = 2
             db.session.commit()
 
-            first_question = person_model.follow_up_questions[0]
-            message = "Let's begin with the follow-up questions.\n\n"
             if isinstance(first_question, dict):
-                message += first_question.get('question', '')
-            else:
-                message += first_question
-
-            return message
+                first_question = first_question.get('question', '')
+            return f"Let's begin with the follow-up questions.\n\n{first_question}"
 
         except Exception as e:
             logger.error(f"Error in second pass transition: {str(e)}")
             return "I encountered an error preparing the follow-up questions. Please try again."
 
-    def _get_or_create_thread(self, session_id):
-        """Get existing thread or create new one with thread safety"""
-        with self._cache_lock:
-            if session_id in self._thread_cache:
-                try:
-                    # Verify thread still exists
-                    self.client.beta.threads.retrieve(self._thread_cache[session_id])
-                    return self._thread_cache[session_id]
-                except Exception:
-                    logger.info(f"Thread expired for session {session_id}, creating new")
-                    pass
-
-            thread = self.client.beta.threads.create()
-            self._thread_cache[session_id] = thread.id
-            return thread.id
+    def _create_run(self, thread_id, user_message):
+        """Start a streamed run on the thread with the new user message attached"""
+        return self.client.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=self.assistant_id,
+            additional_messages=[{"role": "user", "content": user_message}],
+            stream=True,
+            timeout=self._response_timeout
+        )
+
+    def _cancel_run(self, thread_id, run_id):
+        """Cancel a run whose stream was abandoned before it finished"""
+        try:
+            self.client.beta.threads.runs.cancel(run_id, thread_id=thread_id)
+            logger.info(f"Cancelled unfinished run {run_id} on thread {thread_id}")
+        except Exception as e:
+            logger.warning(f"Failed to cancel run {run_id} on thread {thread_id}: {str(e)}")
 
     def _load_recent_messages(self, conversation_id, limit=10):
         """Load only the most recent messages for context"""
         with current_app.app_context():
-            messages = Message.query.filter_by(conversation_id=conversation_id)\
-                .order_by(Message.created_at.desc())\
-                .limit(limit)\
-                .all()
+            rows = db.session.execute(
+                select(Message.role, Message.content)
+                .where(Message.conversation_id == conversation_id)
+                .order_by(Message.created_at.desc())
+                .limit(limit)
+            ).all()
             return [{
-                "role": msg.role,
-                "content": msg.content
-            } for msg in reversed(messages)]  # Reverse to get chronological order
+                "role": role,
+                "content": content
+            } for role, content in reversed(rows)]  # Reverse to get chronological order
 
     def _can_run_evaluation(self, session_id, conversation_id):
         """Check if enough conversation has accumulated for evaluation"""
@@ -353,12 +410,4 @@ class OpenAIAssistant:
 
     def detect_end_interview_trigger(self, message):
         """Check if user message indicates wanting to end the interview"""
-        trigger_phrases = [
-            "end interview",
-            "finish interview",
-            "conclude interview",
-            "that's all",
-            "we're done",
-            "wrap up"
-        ]
-        return any(phrase in message.lower() for phrase in trigger_phrases)
\ No newline at end of file
+        return bool(_END_INTERVIEW_RE.search(message))
\ No newline at end of file
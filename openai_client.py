@@ -0,0 +1,31 @@
+"""Shared OpenAI client with a pooled HTTP connection."""
+import os
+import logging
+from threading import Lock
+import httpx
+from openai import OpenAI, DefaultHttpxClient
+
+logger = logging.getLogger(__name__)
+
+# One client per process so keep-alive connections to the API are reused
+_client = None
+_client_lock = Lock()
+
+def get_openai_client():
+    """Return the process-wide OpenAI client, creating it on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                logger.info("Creating shared OpenAI client")
+                _client = OpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    # Retries back off exponentially on connection errors, 429s and 5xx responses
+                    max_retries=3,
+                    # HTTP/2 multiplexes concurrent requests over the pooled connections
+                    http_client=DefaultHttpxClient(
+                        http2=True,
+                        limits=httpx.Limits(max_connections=50, max_keepalive_connections=25)
+                    )
+                )
+    return _client
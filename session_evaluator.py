@@ -1,162 +1,190 @@
 import logging
-import json
+import orjson
 import os
-from openai import OpenAI
-from models import Conversation, Message, PersonModel
+import hashlib
+import httpx
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete, or_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import Conversation, Message, PersonModel, LLMCache, InterimEvaluation
 from database import db
+from openai import APIConnectionError
+from openai_client import get_openai_client
 from flask import current_app
+from gevent.pool import Pool
+from threading import Lock
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
-class SessionEvaluator:
-    def __init__(self):
-        self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Model used for evaluation calls; the mini tier is much cheaper and faster than gpt-4
+EVAL_MODEL = os.environ.get("EVAL_MODEL", "gpt-4o-mini")
 
-        # Load the empty model template
-        try:
-            with open('empty_model_001.json', 'r') as f:
-                self.model_template = json.load(f)
-        except FileNotFoundError:
-            logger.error("empty_model_001.json not found, this is required for proper evaluation")
-            raise
+# Model used to write follow-up questions, a simpler task than the extraction itself
+FOLLOWUP_MODEL = os.environ.get("OPENAI_FOLLOWUP_MODEL", "gpt-4o-mini")
 
-    def get_conversation_history(self, conversation_id):
-        """Retrieve full conversation history"""
-        messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.created_at).all()
-        return [{"role": msg.role, "content": msg.content} for msg in messages]
+# Token budget for the transcript sent to the extraction call; older turns beyond it are dropped
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "6000"))
 
-    def analyze_conversation(self, session_id):
-        """Analyze conversation and generate structured insights"""
-        try:
-            logger.info(f"Starting interim conversation analysis for session {session_id}")
+# Opening messages always kept when a transcript has to be windowed
+HISTORY_HEAD_MESSAGES = int(os.environ.get("HISTORY_HEAD_MESSAGES", "2"))
 
-            # Ensure we're in an app context
-            if not current_app:
-                raise RuntimeError("This function must be called within an application context")
+# Rough characters per token for English text, used to estimate transcript size
+CHARS_PER_TOKEN = 4
 
-            # Find conversation by session_id
-            conversation = Conversation.query.filter_by(session_id=session_id).first()
-            if not conversation:
-                logger.error(f"No conversation found for session {session_id}")
-                raise ValueError(f"No conversation found for session {session_id}")
-
-            # Get conversation history
-            history = self.get_conversation_history(conversation.id)
-            if not history:
-                logger.error("No messages found in conversation")
-                raise ValueError("No messages found in conversation")
-
-            logger.info(f"Retrieved {len(history)} messages for analysis")
-
-            # Format conversation for analysis
-            formatted_conversation = "\n".join([
-                f"{msg['role'].upper()}: {msg['content']}"
-                for msg in history
-            ])
-
-            # Prepare system prompt with emphasis on interim nature
-            system_prompt = f"""Analyze this ongoing interview conversation and extract current insights about the person.
-            This is a mid-interview evaluation - do not make final conclusions as the interview is still in progress.
-            Generate a JSON response following this exact model structure:
-
-            {json.dumps(self.model_template, indent=2)}
-
-            Guidelines for analysis:
-            1. For each section, provide analysis based on available information only
-            2. Use "insufficient data" for any attribute without clear evidence
-            3. Mark uncertain interpretations clearly
-            4. Focus on identifying areas needing more exploration
-            5. Consider this an interim assessment that will be refined
-            6. Use direct quotes or paraphrased evidence where available
-
-            Your response must be a valid JSON object matching the provided structure.
-            For missing information, use null or empty strings rather than making assumptions."""
-
-            logger.info("Sending interim analysis request to OpenAI")
-            # Process with OpenAI
-            response = self.client.chat.completions.create(
-                model="gpt-4-0125-preview",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": system_prompt
-                    },
-                    {"role": "user", "content": formatted_conversation}
-                ],
-                response_format={"type": "json_object"}
-            )
+# Transcript line prefixes per speaker; roles outside this set fall back to str.upper()
+ROLE_PREFIXES = {"user": "USER: ", "assistant": "ASSISTANT: ", "system": "SYSTEM: "}
 
-            # Parse the structured insights
-            structured_data = json.loads(response.choices[0].message.content)
-            logger.info("Successfully received and parsed OpenAI response")
-            logger.debug(f"Structured data: {json.dumps(structured_data, indent=2)}")
+# Sampling settings for the extraction call. Temperature 0 keeps answers deterministic, so
+# they can be cached, and max_tokens covers the template's worst case plus follow-up questions.
+EXTRACTION_OPTIONS = {"temperature": 0, "max_tokens": 4000, "seed": 42}
 
-            # Identify missing topics
-            missing_topics = self.identify_missing_topics(structured_data)
-            logger.info(f"Identified {len(missing_topics)} topics needing more exploration")
+# Failures worth repeating a streamed extraction for without streaming; anything else, such as
+# a response cut off at max_tokens, would fail the same way again
+TRANSPORT_ERRORS = (APIConnectionError, httpx.TransportError)
 
-            # Generate follow-up questions emphasizing ongoing nature
-            follow_up_questions = self.generate_follow_up_questions(missing_topics, is_interim=True)
-            logger.info(f"Generated {len(follow_up_questions)} potential follow-up questions")
-
-            # Prepare debug info
-            debug_info = {
-                "system_prompt": system_prompt,
-                "conversation_history": formatted_conversation,
-                "raw_response": response.choices[0].message.content,
-                "model_used": "gpt-4-0125-preview",
-                "conversation_length": len(history),
-                "missing_fields_count": len(missing_topics),
-                "generated_questions_count": len(follow_up_questions),
-                "evaluation_type": "interim"
-            }
+# Sampling settings for each session's follow-up questions; a little variety helps here
+FOLLOWUP_OPTIONS = {"temperature": 0.2, "max_tokens": 800, "seed": 42}
 
-            # Store or update the model
-            person_model = PersonModel.query.filter_by(conversation_id=conversation.id).first()
-            if person_model:
-                logger.info("Updating existing person model with interim assessment")
-                person_model.data_model = structured_data
-                person_model.missing_topics = missing_topics
-                person_model.follow_up_questions = follow_up_questions
-                person_model.debug_info = debug_info
-            else:
-                logger.info("Creating new person model from interim assessment")
-                person_model = PersonModel(
-                    conversation_id=conversation.id,
-                    data_model=structured_data,
-                    missing_topics=missing_topics,
-                    follow_up_questions=follow_up_questions,
-                    debug_info=debug_info
-                )
-                db.session.add(person_model)
+# How long an identical analysis request is answered from the LLM cache
+LLM_CACHE_TTL = timedelta(days=7)
 
-            db.session.commit()
-            logger.info(f"Successfully stored interim evaluation for session {session_id}")
+# Only deterministic extraction responses are worth caching
+EXTRACTION_CACHEABLE = EXTRACTION_OPTIONS["temperature"] == 0
 
-            return {
-                "success": True,
-                "model": structured_data,
-                "missing_topics": missing_topics,
-                "follow_up_questions": follow_up_questions,
-                "debug_info": debug_info,
-                "evaluation_type": "interim"
-            }
+# Missing topics and follow-up questions for recently seen extraction results, keyed by a
+# digest of the structured data, so an unchanged result skips the template walk and API call
+FOLLOW_UP_CACHE_SIZE = 256
+_follow_up_cache = OrderedDict()
+_follow_up_lock = Lock()
 
-        except Exception as e:
-            logger.error(f"Error in interim analysis: {str(e)}", exc_info=True)
-            return {
-                "success": False,
-                "error": str(e)
-            }
+# Maximum sessions whose follow-up questions are generated in a single request, and how
+# many of those requests run at once
+FOLLOW_UP_BULK_SIZE = 8
+FOLLOW_UP_CONCURRENCY = 4
 
-    def generate_follow_up_questions(self, missing_topics, is_interim=False):
-        """Generate specific follow-up questions for missing topics"""
-        if not missing_topics:
-            return []
+# The empty person model template, loaded once at import and shared by every evaluator
+try:
+    with open('empty_model_001.json', 'rb') as f:
+        _TEMPLATE = orjson.loads(f.read())
+except FileNotFoundError:
+    logger.error("empty_model_001.json not found, this is required for proper evaluation")
+    raise
 
-        topics_str = "\n".join([f"- {topic}" for topic in missing_topics])
+# Sentinel for a path that does not resolve in the extracted data
+_MISSING = object()
+
+def _flatten_template(template, path=()):
+    """Yield (path, kind) for every template field in walk order, skipping definitions and examples"""
+    for key, value in template.items():
+        if key in ('definition', 'example'):
+            continue
+        key_path = path + (key,)
+        if isinstance(value, dict):
+            yield key_path, 'dict'
+            yield from _flatten_template(value, key_path)
+        elif isinstance(value, list):
+            yield key_path, 'list'
+        else:
+            yield key_path, 'value'
+
+def _template_schema(template):
+    """Build a strict JSON schema matching the template's structure, without definitions and examples"""
+    if isinstance(template, dict):
+        properties = {
+            key: _template_schema(value)
+            for key, value in template.items()
+            if key not in ('definition', 'example')
+        }
+        return {
+            "type": "object",
+            "properties": properties,
+            "required": list(properties),
+            "additionalProperties": False
+        }
+    if isinstance(template, list):
+        return {"type": "array", "items": {"type": "string"}}
+    if template is None:
+        # Unset scores such as analytical_intuitive_balance, or "insufficient data"
+        return {"type": ["number", "string", "null"]}
+    return {"type": ["string", "null"]}
+
+def _check_finish_reason(finish_reason):
+    """Raise if an extraction response stopped at max_tokens, leaving its JSON unfinished"""
+    if finish_reason == "length":
+        raise ValueError(f"Analysis response was cut off at max_tokens={EXTRACTION_OPTIONS['max_tokens']}")
+
+class _SectionScanner:
+    """Accumulates a streamed JSON object and spots when its top-level members close"""
+
+    def __init__(self):
+        self._chunks = []
+        self._length = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def text(self):
+        return "".join(self._chunks)
 
-        system_message = """Generate scored follow-up questions to explore missing areas.
+    def feed(self, chunk):
+        """Add a chunk, returning every member closed so far as a dict, or None if none closed"""
+        closed_at = None
+        for offset, char in enumerate(chunk):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 1:
+                    closed_at = self._length + offset + 1
+
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+        if closed_at is None:
+            return None
+
+        # Close the object after the last finished member and parse what we have
+        try:
+            return orjson.loads(self.text()[:closed_at] + "}")
+        except orjson.JSONDecodeError:
+            return None
+
+class SessionEvaluator:
+    # Static instructions for the extraction call; per-request details go in the user message
+    ANALYSIS_SYSTEM_PROMPT = """Analyze this interview conversation and extract insights about the person.
+Generate a JSON response following this exact model structure:
+
+{template}
+
+Guidelines for analysis:
+1. For each section, provide analysis based on available information only
+2. Use "insufficient data" for any attribute without clear evidence
+3. Mark uncertain interpretations clearly
+4. Focus on identifying areas needing more exploration
+5. Use direct quotes or paraphrased evidence where available
+6. Finish with follow_up_questions: open-ended questions that would fill the gaps you found
+   (null, empty or "insufficient data" attributes), each with a relevance score from 1-10
+   and a brief rationale. Score questions about core traits and critical gaps highest.
+
+Your response must be a valid JSON object matching the provided structure.
+For missing information, use null or empty strings rather than making assumptions."""
+
+    # Prepended to the conversation for evaluations made while the interview is ongoing
+    INTERIM_NOTE = ("This is a mid-interview evaluation - do not make final conclusions as the "
+                    "interview is still in progress. Consider this an interim assessment that will be refined.")
+
+    # Instructions for follow-up question generation
+    FOLLOW_UP_SYSTEM_PROMPT = """Generate scored follow-up questions to explore missing areas.
         Each question must include a relevance score from 1-10 based on how well it will improve the person data model.
 
         Output format must be a JSON array of objects with this structure:
@@ -185,60 +213,847 @@ class SessionEvaluator:
 
         Return a minimum of 5 scored questions."""
 
+    # Follow-up instructions when one request covers several sessions
+    FOLLOW_UP_BULK_SYSTEM_PROMPT = FOLLOW_UP_SYSTEM_PROMPT + """
+
+        You will receive missing areas for several interview sessions, each under its session ID.
+        Return one JSON object keyed by session ID, where each value has the structure above:
+        {"<session_id>": {"questions": [...]}}"""
+
+    def __init__(self):
+        self.client = get_openai_client()
+
+        self._template_paths = _TEMPLATE_PATHS
+        self._template_depth = _TEMPLATE_DEPTH
+        self._system_message = _SYSTEM_MESSAGE
+        self._system_prompt_hash = _SYSTEM_PROMPT_HASH
+
+    def get_conversation_history(self, conversation_id):
+        """Retrieve full conversation history"""
+        rows = db.session.execute(
+            select(Message.role, Message.content)
+            .where(Message.conversation_id == conversation_id)
+            .order_by(Message.created_at)
+        ).all()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def _window_transcript(self, rows, token_budget):
+        """Format (role, content) rows as transcript lines that fit in the token budget.
+
+        Over budget, the opening HISTORY_HEAD_MESSAGES turns and as many of the most
+        recent turns as fit are kept, with a marker standing in for the middle.
+        """
+        lines = [(ROLE_PREFIXES.get(role) or f"{role.upper()}: ") + content for role, content in rows]
+        costs = [len(line) // CHARS_PER_TOKEN + 1 for line in lines]
+        if sum(costs) <= token_budget:
+            return lines
+
+        # The opening turns set out the interview's context, so they are kept first
+        head = min(HISTORY_HEAD_MESSAGES, len(rows) - 1)
+        used = sum(costs[:head])
+        start = len(rows) - 1
+        used += costs[start]
+
+        # Walk back from the newest turn, which is always kept
+        while start > head and used + costs[start - 1] <= token_budget:
+            start -= 1
+            used += costs[start]
+
+        # Start the window on a user turn so speakers still alternate
+        while start < len(rows) - 1 and rows[start][0] != 'user':
+            start += 1
+
+        omitted = start - head
+        if not omitted:
+            return lines
+        logger.info(f"Transcript over token budget, dropped {omitted} middle messages")
+        return [*lines[:head], f"[{omitted} earlier messages omitted]", *lines[start:]]
+
+    def analyze_conversation(self, session_id):
+        """Analyze conversation and generate structured insights"""
+        try:
+            logger.info(f"Starting interim conversation analysis for session {session_id}")
+
+            # Ensure we're in an app context
+            if not current_app:
+                raise RuntimeError("This function must be called within an application context")
+
+            conversation_id, history_length, messages, analyzed_through = self._prepare_analysis(session_id)
+
+            # Process with OpenAI, unless this exact request was answered recently
+            structured_data, raw_response, cache_hit, missing_topics, follow_up_questions = \
+                self._extract_structured_data(messages)
+
+            return self._complete_analysis(
+                session_id, conversation_id, history_length, messages, structured_data, raw_response, cache_hit,
+                missing_topics, follow_up_questions, analyzed_through
+            )
+
+        except Exception as e:
+            logger.error(f"Error in interim analysis: {str(e)}", exc_info=True)
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
+    def analyze_conversation_stream(self, session_id):
+        """Analyze conversation like analyze_conversation, yielding progress events for SSE consumers.
+
+        Yields {"type": "section", ...} with each template section's missing topics as soon as
+        the model finishes it, then a final {"type": "result", ...} or {"type": "error", ...}.
+        """
+        try:
+            logger.info(f"Starting streamed interim conversation analysis for session {session_id}")
+            conversation_id, history_length, messages, analyzed_through = self._prepare_analysis(session_id)
+
+            for event in self._iter_extraction(messages):
+                if event[0] == "section":
+                    yield {"type": "section", "section": event[1], "missing_topics": event[2]}
+                else:
+                    structured_data, raw_response, cache_hit, missing_topics, follow_up_questions = event[1]
+
+            result = self._complete_analysis(
+                session_id, conversation_id, history_length, messages, structured_data, raw_response, cache_hit,
+                missing_topics, follow_up_questions, analyzed_through
+            )
+            yield {"type": "result", **result}
+
+        except Exception as e:
+            logger.error(f"Error in streamed interim analysis: {str(e)}", exc_info=True)
+            yield {"type": "error", "success": False, "error": str(e)}
+
+    def _prepare_analysis(self, session_id):
+        """Load a session's conversation and build the analysis request messages.
+
+        Returns (conversation_id, history_length, messages, analyzed_through), where
+        analyzed_through is the creation time of the last message analyzed.
+        """
+        # Find the conversation and its history in one round trip
+        conversation_id, rows, analyzed_through = self._get_session_history(session_id)
+        if not conversation_id:
+            logger.error(f"No conversation found for session {session_id}")
+            raise ValueError(f"No conversation found for session {session_id}")
+
+        # Format the history for analysis straight from the query rows
+        history_length = len(rows)
+        formatted_conversation = "\n".join(self._window_transcript(rows, HISTORY_TOKEN_BUDGET))
+        if not history_length:
+            logger.error("No messages found in conversation")
+            raise ValueError("No messages found in conversation")
+
+        logger.info(f"Retrieved {history_length} messages for analysis")
+
+        return conversation_id, history_length, self._extraction_messages(formatted_conversation), analyzed_through
+
+    def _extraction_messages(self, transcript):
+        """Build the single-session analysis request messages for a transcript"""
+        return [self._system_message, {"role": "user", "content": f"{self.INTERIM_NOTE}\n\n{transcript}"}]
+
+    def _get_session_history(self, session_id):
+        """Look up a session's conversation ID and ordered (role, content) rows in a single query.
+
+        Returns (conversation_id, rows, last_message_at).
+        """
+        result = db.session.execute(
+            select(Conversation.id, Message.role, Message.content, Message.created_at)
+            .outerjoin(Message, Message.conversation_id == Conversation.id)
+            .where(Conversation.session_id == session_id)
+            .order_by(Message.created_at)
+        ).all()
+        if not result:
+            return None, [], None
+        # A conversation without messages comes back as a single row with NULL message columns
+        return result[0][0], [(role, content) for _, role, content, _ in result if role is not None], result[-1][3]
+
+    def _upsert_insert(self):
+        """Return the dialect's INSERT construct with ON CONFLICT support, or None"""
+        dialect = db.session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            return postgresql_insert
+        if dialect == 'sqlite':
+            return sqlite_insert
+        return None
+
+    def _upsert_person_model(self, conversation_id, values):
+        """Insert or update a conversation's person model in a single statement.
+
+        A stored model analyzed from a newer snapshot is left alone, so a late result, such
+        as a Batch API response, never overwrites a fresher evaluation. Returns whether the
+        values were written.
+        """
+        now = datetime.utcnow()
+        insert = self._upsert_insert()
+        if insert:
+            stmt = insert(PersonModel).values(conversation_id=conversation_id, created_at=now, updated_at=now, **values)
+            # Refer to the proposed row rather than binding every JSON payload a second time
+            result = db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[PersonModel.conversation_id],
+                set_={key: stmt.excluded[key] for key in (*values, "updated_at")},
+                where=or_(PersonModel.analyzed_through.is_(None),
+                          PersonModel.analyzed_through <= stmt.excluded.analyzed_through)
+            ))
+            return result.rowcount != 0
+
+        # No ON CONFLICT support, so fall back to read-then-write
+        person_model = PersonModel.query.filter_by(conversation_id=conversation_id).first()
+        if not person_model:
+            db.session.add(PersonModel(conversation_id=conversation_id, **values))
+            return True
+        analyzed_through = values.get("analyzed_through")
+        if person_model.analyzed_through and (not analyzed_through or analyzed_through < person_model.analyzed_through):
+            return False
+        for key, value in values.items():
+            setattr(person_model, key, value)
+        return True
+
+    def _complete_analysis(self, session_id, conversation_id, history_length, messages, structured_data, raw_response,
+                           cache_hit, missing_topics=None, follow_up_questions=None, analyzed_through=None):
+        """Derive missing topics and follow-up questions from extracted data and store the person model.
+
+        analyzed_through is the creation time of the last message the analysis covered.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Structured data: %s", orjson.dumps(structured_data, option=orjson.OPT_INDENT_2).decode())
+
+        # An unchanged extraction result yields the same gaps, so reuse what it produced last time
+        digest = hashlib.blake2b(
+            orjson.dumps(structured_data, option=orjson.OPT_SORT_KEYS), digest_size=16
+        ).digest()
+        if follow_up_questions is None:
+            with _follow_up_lock:
+                cached = _follow_up_cache.get(digest)
+                if cached:
+                    _follow_up_cache.move_to_end(digest)
+            if cached:
+                logger.info("Reusing missing topics and follow-up questions for unchanged analysis")
+                missing_topics, follow_up_questions = cached
+
+        # Identify missing topics, unless they were worked out while the response streamed
+        if missing_topics is None:
+            missing_topics = self.identify_missing_topics(structured_data)
+        logger.info(f"Identified {len(missing_topics)} topics needing more exploration")
+
+        # Generate follow-up questions emphasizing ongoing nature, unless generated in bulk
+        if follow_up_questions is None:
+            follow_up_questions = self.generate_follow_up_questions(missing_topics, is_interim=True)
+        logger.info(f"Generated {len(follow_up_questions)} potential follow-up questions")
+
+        # An empty list for real gaps means generation failed, which is worth retrying next time
+        if follow_up_questions or not missing_topics:
+            with _follow_up_lock:
+                _follow_up_cache[digest] = (missing_topics, follow_up_questions)
+                _follow_up_cache.move_to_end(digest)
+                if len(_follow_up_cache) > FOLLOW_UP_CACHE_SIZE:
+                    _follow_up_cache.popitem(last=False)
+
+        # Prepare debug info
+        debug_info = {
+            "system_prompt": messages[0]["content"],
+            "conversation_history": messages[1]["content"],
+            "raw_response": raw_response,
+            "model_used": EVAL_MODEL,
+            "follow_up_model_used": FOLLOWUP_MODEL,
+            "cache_hit": cache_hit,
+            "conversation_length": history_length,
+            "missing_fields_count": len(missing_topics),
+            "generated_questions_count": len(follow_up_questions),
+            "evaluation_type": "interim"
+        }
+
+        # Store or update the model
+        logger.info("Storing person model from interim assessment")
+        stored = self._upsert_person_model(conversation_id, {
+            "data_model": structured_data,
+            "missing_topics": missing_topics,
+            "follow_up_questions": follow_up_questions,
+            "debug_info": debug_info,
+            "analyzed_through": analyzed_through
+        })
+
+        db.session.commit()
+        if stored:
+            logger.info(f"Successfully stored interim evaluation for session {session_id}")
+        else:
+            logger.info(f"Kept the stored evaluation for session {session_id}, which covers a newer snapshot")
+
+        return {
+            "success": True,
+            "model": structured_data,
+            "missing_topics": missing_topics,
+            "follow_up_questions": follow_up_questions,
+            "debug_info": debug_info,
+            "evaluation_type": "interim"
+        }
+
+    def _extract_structured_data(self, messages):
+        """Run the structured extraction call, served from the LLM cache when possible.
+
+        Returns (structured_data, raw_response, cache_hit, missing_topics, follow_up_questions),
+        where missing_topics is None unless it was computed while the response streamed, and
+        follow_up_questions is None if the response did not include any.
+        Only deterministic (temperature 0) requests are cached, since only they
+        yield an equivalent answer for an identical request.
+        """
+        for event in self._iter_extraction(messages):
+            if event[0] == "done":
+                return event[1]
+
+    def _iter_extraction(self, messages):
+        """Run the extraction as in _extract_structured_data, yielding progress as it streams.
+
+        Yields ("section", key, missing_topics) as each template section closes, then
+        ("done", result) with the tuple _extract_structured_data returns.
+        """
+        key = self._extraction_cache_key(messages)
+        cached = self._get_cached_extractions([key]).get(key)
+        if cached:
+            logger.info("Using cached analysis response")
+            structured_data, follow_up_questions = self._split_follow_ups(cached)
+            yield "done", (structured_data, orjson.dumps(cached).decode(), True, None, follow_up_questions)
+            return
+
+        logger.info("Sending interim analysis request to OpenAI")
+        try:
+            for event in self._stream_structured_data(messages):
+                if event[0] == "done":
+                    response_data, raw_response, missing_topics = event[1]
+                else:
+                    yield event
+        except TRANSPORT_ERRORS as e:
+            logger.warning(f"Streamed analysis failed, retrying without streaming: {str(e)}")
+            response = self.client.chat.completions.create(
+                model=EVAL_MODEL,
+                messages=messages,
+                response_format=_RESPONSE_FORMAT,
+                **EXTRACTION_OPTIONS
+            )
+            _check_finish_reason(response.choices[0].finish_reason)
+            raw_response = response.choices[0].message.content
+            response_data = orjson.loads(raw_response)
+            missing_topics = None
+        logger.info("Successfully received and parsed OpenAI response")
+
+        self._cache_extraction(key, response_data)
+        structured_data, follow_up_questions = self._split_follow_ups(response_data)
+        yield "done", (structured_data, raw_response, False, missing_topics, follow_up_questions)
+
+    def _extraction_cache_key(self, messages):
+        """Key the LLM cache on everything that determines a single-session extraction response"""
+        # The system prompt is fixed, so its precomputed digest stands in for it
+        request = orjson.dumps({
+            "model": EVAL_MODEL,
+            "system_prompt": self._system_prompt_hash,
+            "options": EXTRACTION_OPTIONS,
+            "messages": messages[1:]
+        }, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(request).hexdigest()
+
+    def _get_cached_extractions(self, keys):
+        """Look up unexpired cached extraction responses in one query, keyed by cache key"""
+        if not EXTRACTION_CACHEABLE or not keys:
+            return {}
+        rows = db.session.execute(
+            select(LLMCache.key, LLMCache.response)
+            .where(LLMCache.key.in_(keys), LLMCache.expires_at > datetime.utcnow())
+        ).all()
+        return {key: response for key, response in rows if isinstance(response, dict)}
+
+    def _cache_extraction(self, key, response_data):
+        """Add an extraction response to the LLM cache.
+
+        The entry is committed together with the person model. It is upserted in one
+        statement, so concurrent evaluations of the same transcript don't collide on the key.
+        """
+        if not EXTRACTION_CACHEABLE:
+            return
+        values = {"key": key, "response": response_data, "expires_at": datetime.utcnow() + LLM_CACHE_TTL}
+        insert = self._upsert_insert()
+        if insert:
+            stmt = insert(LLMCache).values(created_at=datetime.utcnow(), **values)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=[LLMCache.key],
+                set_={column: stmt.excluded[column] for column in ("response", "created_at", "expires_at")}
+            ))
+        else:
+            db.session.merge(LLMCache(**values))
+
+    def purge_expired_cache(self):
+        """Delete expired LLM cache entries, returning the number removed"""
+        removed = db.session.execute(delete(LLMCache).where(LLMCache.expires_at <= datetime.utcnow())).rowcount
+        db.session.commit()
+        return removed
+
+    def _split_follow_ups(self, response_data):
+        """Separate the follow-up questions from an extraction response.
+
+        Returns (structured_data, follow_up_questions), with follow_up_questions None if
+        the response has none, so the caller falls back to a separate request.
+        """
+        structured_data = dict(response_data)
+        questions = structured_data.pop("follow_up_questions", None)
+        if not questions or not isinstance(questions, list):
+            return structured_data, None
+        return structured_data, self._parse_follow_up_questions({"questions": questions})
+
+    def _stream_structured_data(self, messages):
+        """Stream the extraction call, checking each template section for gaps as soon as it closes.
+
+        Yields ("section", key, missing_topics) per closed section, then
+        ("done", (response_data, raw_response, missing_topics)).
+        """
+        stream = self.client.chat.completions.create(
+            model=EVAL_MODEL,
+            messages=messages,
+            response_format=_RESPONSE_FORMAT,
+            stream=True,
+            **EXTRACTION_OPTIONS
+        )
+
+        scanner = _SectionScanner()
+        section_missing = {}
+        finish_reason = None
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+            if not chunk.choices[0].delta.content:
+                continue
+            closed = scanner.feed(chunk.choices[0].delta.content)
+            if closed:
+                # Diff the finished sections while the rest of the response is still decoding
+                for key, paths in _TEMPLATE_SECTIONS.items():
+                    if key in closed and key not in section_missing:
+                        section_missing[key] = self.identify_missing_topics(closed, paths)
+                        yield "section", key, section_missing[key]
+
+        _check_finish_reason(finish_reason)
+        raw_response = scanner.text()
+        response_data = orjson.loads(raw_response)
+
+        # Sections that never closed mid-stream are checked against the final object
+        missing_topics = []
+        for key, paths in _TEMPLATE_SECTIONS.items():
+            if key not in section_missing:
+                section_missing[key] = self.identify_missing_topics(response_data, paths)
+            missing_topics.extend(section_missing[key])
+        yield "done", (response_data, raw_response, missing_topics)
+
+    def queue_interim(self, session_id):
+        """Queue a non-urgent interim evaluation for the next Batch API submission"""
+        try:
+            _, history_length, messages, analyzed_through = self._prepare_analysis(session_id)
+        except ValueError as e:
+            logger.warning(f"Not queueing interim evaluation: {str(e)}")
+            return False
+
+        # A newer snapshot of the same session replaces the queued one
+        InterimEvaluation.query.filter_by(session_id=session_id, batch_id=None).delete()
+        db.session.add(InterimEvaluation(
+            session_id=session_id,
+            history_length=history_length,
+            messages=messages,
+            analyzed_through=analyzed_through
+        ))
+        db.session.commit()
+        logger.info(f"Queued interim evaluation for session {session_id}")
+        return True
+
+    def submit_interim_batch(self):
+        """Upload queued interim evaluations as one Batch API job, returning its ID"""
+        # Locked rows are skipped, so another worker process never submits them twice
+        rows = InterimEvaluation.query.filter_by(batch_id=None)\
+            .order_by(InterimEvaluation.id)\
+            .with_for_update(skip_locked=True)\
+            .all()
+        if not rows:
+            db.session.rollback()
+            return None
+
+        # A session queued twice is submitted once, with its newest snapshot
+        pending = {row.session_id: row.messages for row in rows}
+        lines = [orjson.dumps({
+            "custom_id": session_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": EVAL_MODEL,
+                "messages": messages,
+                "response_format": _RESPONSE_FORMAT,
+                **EXTRACTION_OPTIONS
+            }
+        }) for session_id, messages in pending.items()]
+
+        try:
+            batch_file = self.client.files.create(
+                file=("interim_evaluations.jsonl", b"\n".join(lines)),
+                purpose="batch"
+            )
+            batch = self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+        except Exception:
+            # The requests stay queued, so the next submission retries them
+            db.session.rollback()
+            raise
+
+        InterimEvaluation.query.filter(InterimEvaluation.id.in_([row.id for row in rows]))\
+            .update({"batch_id": batch.id}, synchronize_session=False)
+        db.session.commit()
+        logger.info(f"Submitted interim batch {batch.id} with {len(pending)} evaluations")
+        return batch.id
+
+    def collect_interim_batches(self):
+        """Store the results of finished interim batches, returning the number stored"""
+        batch_ids = [batch_id for (batch_id,) in db.session.query(InterimEvaluation.batch_id)
+                     .filter(InterimEvaluation.batch_id.isnot(None))
+                     .distinct()]
+
+        stored = 0
+        for batch_id in batch_ids:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in ('failed', 'expired', 'cancelled'):
+                logger.error(f"Interim batch {batch_id} ended with status {batch.status}")
+            elif batch.status != 'completed':
+                continue
+
+            # Expired and cancelled batches can still have finished some requests
+            pending = {
+                row.session_id: (row.history_length, row.messages, row.analyzed_through)
+                for row in InterimEvaluation.query.filter_by(batch_id=batch_id).order_by(InterimEvaluation.id)
+            }
+            if batch.output_file_id:
+                output = self.client.files.content(batch.output_file_id).text
+                results = [orjson.loads(line) for line in output.splitlines() if line.strip()]
+                stored += self._store_batch_results(results, pending)
+            if batch.error_file_id:
+                self._log_batch_errors(batch_id, self.client.files.content(batch.error_file_id).text)
+
+            InterimEvaluation.query.filter_by(batch_id=batch_id).delete()
+            db.session.commit()
+
+        return stored
+
+    def _log_batch_errors(self, batch_id, error_output):
+        """Log each request of a batch's error file, which the output file leaves out"""
+        for line in error_output.splitlines():
+            if not line.strip():
+                continue
+            result = orjson.loads(line)
+            response = result.get("response") or {}
+            error = result.get("error") or (response.get("body") or {}).get("error") or response.get("status_code")
+            logger.error(f"Interim batch {batch_id} request for session {result.get('custom_id')} failed: {error}")
+
+    def _store_batch_results(self, results, pending):
+        """Complete the analyses for a finished batch's output lines, returning the number stored.
+
+        Follow-up questions missing from the responses are generated together,
+        FOLLOW_UP_BULK_SIZE sessions per request.
+        """
+        extracted = {}
+        follow_ups = {}
+        for result in results:
+            session_id = result.get("custom_id")
+            try:
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    raise ValueError(f"Batch request failed: {result.get('error') or response.get('status_code')}")
+
+                choice = response["body"]["choices"][0]
+                _check_finish_reason(choice.get("finish_reason"))
+                raw_response = choice["message"]["content"]
+                response_data = orjson.loads(raw_response)
+                structured_data, follow_up_questions = self._split_follow_ups(response_data)
+                extracted[session_id] = (
+                    structured_data, raw_response, self.identify_missing_topics(structured_data), response_data
+                )
+                if follow_up_questions is not None:
+                    follow_ups[session_id] = follow_up_questions
+
+            except Exception as e:
+                logger.error(f"Error reading interim batch result for session {session_id}: {str(e)}", exc_info=True)
+
+        def generate(chunk):
+            try:
+                return self.generate_follow_up_questions_bulk(
+                    {session_id: extracted[session_id][2] for session_id in chunk}
+                )
+            except Exception as e:
+                logger.error(f"Error generating bulk follow-up questions: {str(e)}", exc_info=True)
+                return {}
+
+        # Follow-up requests touch no database state, so they can all be in flight at once
+        session_ids = [session_id for session_id in extracted if session_id not in follow_ups]
+        chunks = [session_ids[i:i + FOLLOW_UP_BULK_SIZE] for i in range(0, len(session_ids), FOLLOW_UP_BULK_SIZE)]
+        for chunk_follow_ups in Pool(FOLLOW_UP_CONCURRENCY).imap_unordered(generate, chunks):
+            follow_ups.update(chunk_follow_ups)
+
+        # Resolve every conversation up front so each session costs only its upsert
+        conversation_ids = dict(db.session.execute(
+            select(Conversation.session_id, Conversation.id).where(Conversation.session_id.in_(list(extracted)))
+        ).all()) if extracted else {}
+
+        # Sessions without bulk follow-ups fall back to one follow-up request each
+        stored = 0
+        for session_id, (structured_data, raw_response, missing_topics, response_data) in extracted.items():
+            try:
+                conversation_id = conversation_ids.get(session_id)
+                if not conversation_id:
+                    raise ValueError(f"No conversation found for session {session_id}")
+
+                history_length, messages, analyzed_through = pending[session_id]
+                # Batch requests are single-session extractions, so they share the synchronous cache
+                self._cache_extraction(self._extraction_cache_key(messages), response_data)
+                self._complete_analysis(
+                    session_id, conversation_id, history_length, messages, structured_data, raw_response, False,
+                    missing_topics, follow_ups.get(session_id), analyzed_through
+                )
+                stored += 1
+
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error storing interim batch result for session {session_id}: {str(e)}", exc_info=True)
+
+        return stored
+
+    def generate_follow_up_questions(self, missing_topics, is_interim=False):
+        """Generate specific follow-up questions for missing topics"""
+        if not missing_topics:
+            return []
+
+        topics_str = "\n".join([f"- {topic}" for topic in missing_topics])
+
+        system_message = self.FOLLOW_UP_SYSTEM_PROMPT
+
         response = self.client.chat.completions.create(
-            model="gpt-4-0125-preview",
+            model=FOLLOWUP_MODEL,
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": f"Generate scored follow-up questions for these missing areas:\n{topics_str}"}
             ],
-            response_format={"type": "json_object"}
+            response_format={"type": "json_object"},
+            **FOLLOWUP_OPTIONS
         )
 
         try:
-            result = json.loads(response.choices[0].message.content)
-            # Sort questions by score in descending order
-            questions = sorted(
-                result.get("questions", []),
-                key=lambda x: x.get("score", 0),
-                reverse=True
-            )
+            return self._parse_follow_up_questions(orjson.loads(response.choices[0].message.content))
 
-            if not questions:
-                logger.warning("No questions generated by OpenAI")
-                return []
+        except Exception as e:
+            logger.error(f"Error parsing follow-up questions: {str(e)}")
+            return []
 
-            logger.info(f"Generated {len(questions)} scored follow-up questions")
-            for q in questions:
-                logger.debug(f"Question (Score {q.get('score')}): {q.get('question')}")
-                logger.debug(f"Rationale: {q.get('rationale')}")
+    def generate_follow_up_questions_bulk(self, missing_by_session):
+        """Generate follow-up questions for several sessions in one call, returning questions keyed by session ID.
+
+        Sessions the response leaves out are omitted from the result.
+        """
+        follow_ups = {session_id: [] for session_id, topics in missing_by_session.items() if not topics}
+        missing_by_session = {session_id: topics for session_id, topics in missing_by_session.items() if topics}
+        if not missing_by_session:
+            return follow_ups
+
+        topics_str = "\n\n".join(
+            f"Session {session_id}:\n" + "\n".join(f"- {topic}" for topic in topics)
+            for session_id, topics in missing_by_session.items()
+        )
 
-            return questions
+        logger.info(f"Generating follow-up questions for {len(missing_by_session)} sessions in one request")
+        response = self.client.chat.completions.create(
+            model=FOLLOWUP_MODEL,
+            messages=[
+                {"role": "system", "content": self.FOLLOW_UP_BULK_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Generate scored follow-up questions for these missing areas:\n\n{topics_str}"}
+            ],
+            response_format={"type": "json_object"},
+            # Output grows with the number of sessions answered
+            **{**FOLLOWUP_OPTIONS, "max_tokens": FOLLOWUP_OPTIONS["max_tokens"] * len(missing_by_session)}
+        )
 
+        try:
+            result = orjson.loads(response.choices[0].message.content)
         except Exception as e:
-            logger.error(f"Error parsing follow-up questions: {str(e)}")
+            logger.error(f"Error parsing bulk follow-up questions: {str(e)}")
+            return follow_ups
+
+        for session_id in missing_by_session:
+            session_result = result.get(session_id)
+            if isinstance(session_result, dict):
+                follow_ups[session_id] = self._parse_follow_up_questions(session_result)
+            else:
+                logger.warning(f"No follow-up questions returned for session {session_id}")
+        return follow_ups
+
+    def _parse_follow_up_questions(self, result):
+        """Return the questions from a parsed follow-up response, highest score first"""
+        # Sort questions by score in descending order
+        questions = sorted(
+            result.get("questions", []),
+            key=lambda x: x.get("score", 0),
+            reverse=True
+        )
+
+        if not questions:
+            logger.warning("No questions generated by OpenAI")
             return []
 
-    def identify_missing_topics(self, structured_data):
-        """Compare extracted data with template to identify missing or incomplete topics"""
+        logger.info(f"Generated {len(questions)} scored follow-up questions")
+        if logger.isEnabledFor(logging.DEBUG):
+            for q in questions:
+                logger.debug("Question (Score %s): %s", q.get('score'), q.get('question'))
+                logger.debug("Rationale: %s", q.get('rationale'))
+
+        return questions
+
+    def identify_missing_topics(self, structured_data, paths=None):
+        """Compare extracted data with template to identify missing or incomplete topics.
+
+        paths limits the check to a subset of the flattened template, such as one section.
+        """
+        entries = self._template_paths if paths is None else paths
+        check = _MISSING_CHECKS.get(id(entries))
+        if check:
+            return check(structured_data)
+
         missing_topics = []
 
-        def check_missing_fields(template, data, path=""):
-            if isinstance(template, dict):
-                for key, value in template.items():
-                    new_path = f"{path}.{key}" if path else key
-
-                    # Skip checking definition and example fields
-                    if key in ['definition', 'example']:
-                        continue
-
-                    if key not in data:
-                        missing_topics.append(new_path)
-                    elif isinstance(value, (dict, list)):
-                        check_missing_fields(value, data[key], new_path)
-                    elif not data[key] and data[key] != 0:  # Allow 0 as a valid value
-                        missing_topics.append(new_path)
-            elif isinstance(template, list) and not data:
-                missing_topics.append(path)
-
-        check_missing_fields(self.model_template, structured_data)
-        return missing_topics
\ No newline at end of file
+        # Resolved section at each depth; entries come in walk order, so a field's
+        # parent section is always the one most recently resolved one level up
+        sections = [_MISSING] * (self._template_depth + 1)
+        sections[0] = structured_data
+
+        i = 0
+        while i < len(entries):
+            path, key, depth, kind, span = entries[i]
+            parent = sections[depth]
+            value = parent.get(key, _MISSING) if isinstance(parent, dict) else _MISSING
+
+            if value is _MISSING:
+                missing_topics.append(".".join(path))
+                # Everything beneath a missing field is covered by reporting the field itself
+                i += span + 1
+                continue
+
+            if kind == 'dict':
+                sections[depth + 1] = value
+            elif kind == 'list' and not value:
+                missing_topics.append(".".join(path))
+            elif kind == 'value' and not value and value != 0:  # Allow 0 as a valid value
+                missing_topics.append(".".join(path))
+            i += 1
+
+        return missing_topics
+
+# Everything derived from the template is fixed for the life of the process, so it is
+# computed once here rather than in every evaluator's constructor.
+
+def _index_template_paths(flattened):
+    """Annotate flattened (path, kind) entries with their leaf key, depth and descendant count"""
+    entries = [(path, path[-1], len(path) - 1, kind) for path, kind in flattened]
+    indexed = []
+    for i, (path, key, depth, kind) in enumerate(entries):
+        end = i + 1
+        while end < len(entries) and entries[end][2] > depth:
+            end += 1
+        indexed.append((path, key, depth, kind, end - i - 1))
+    return tuple(indexed)
+
+# Field paths to check on every evaluation. Each entry carries its depth so the walk can
+# find the parent without slicing the path, and its descendant count so a missing section
+# is skipped in one step.
+_TEMPLATE_PATHS = _index_template_paths(_flatten_template(_TEMPLATE))
+
+# Flattened paths grouped by top-level section, so one section can be checked on its own
+_TEMPLATE_SECTIONS = {}
+for _entry in _TEMPLATE_PATHS:
+    _TEMPLATE_SECTIONS.setdefault(_entry[0][0], []).append(_entry)
+_TEMPLATE_SECTIONS = {key: tuple(entries) for key, entries in _TEMPLATE_SECTIONS.items()}
+
+_TEMPLATE_DEPTH = max((entry[2] for entry in _TEMPLATE_PATHS), default=0) + 1
+
+def _compile_missing_check(entries, name):
+    """Generate identify_missing_topics for a fixed run of entries as straight-line code.
+
+    Each section's fields become inline dict lookups nested under their parent, so a
+    missing section skips its fields without any walk bookkeeping.
+    """
+    lines = [f"def {name}(s0):", "    missing = []", "    add = missing.append"]
+
+    def emit(start, end, depth, indent):
+        pad = "    " * indent
+        children = []
+        i = start
+        while i < end:
+            children.append(entries[i])
+            i += entries[i][4] + 1
+
+        lines.append(f"{pad}if isinstance(s{depth}, dict):")
+        i = start
+        for path, key, _, kind, span in children:
+            topic = repr(".".join(path))
+            lines.append(f"{pad}    v = s{depth}.get({key!r}, MISSING)")
+            lines.append(f"{pad}    if v is MISSING:")
+            lines.append(f"{pad}        add({topic})")
+            if kind == 'dict' and span:
+                lines.append(f"{pad}    else:")
+                lines.append(f"{pad}        s{depth + 1} = v")
+                emit(i + 1, i + 1 + span, depth + 1, indent + 2)
+            elif kind == 'list':
+                lines.append(f"{pad}    elif not v:")
+                lines.append(f"{pad}        add({topic})")
+            elif kind == 'value':
+                lines.append(f"{pad}    elif not v and v != 0:  # Allow 0 as a valid value")
+                lines.append(f"{pad}        add({topic})")
+            i += span + 1
+        # A section that is present but not an object is missing every field directly under it
+        lines.append(f"{pad}else:")
+        for path, *_ in children:
+            lines.append(f"{pad}    add({'.'.join(path)!r})")
+
+    if entries:
+        emit(0, len(entries), 0, 1)
+    lines.append("    return missing")
+    namespace = {"MISSING": _MISSING}
+    exec(compile("\n".join(lines), f"<{name}>", "exec"), namespace)
+    return namespace[name]
+
+# The template walk unrolled for the whole template and for each section. Keyed by the
+# identity of the entry tuples above, which live as long as the module; any other paths
+# fall back to the generic walk.
+_MISSING_CHECKS = {id(_TEMPLATE_PATHS): _compile_missing_check(_TEMPLATE_PATHS, "_check_template")}
+for _key, _entries in _TEMPLATE_SECTIONS.items():
+    _MISSING_CHECKS[id(_entries)] = _compile_missing_check(_entries, "_check_section")
+
+_TEMPLATE_JSON = orjson.dumps(_TEMPLATE, option=orjson.OPT_INDENT_2).decode()
+
+# Identical bytes on every request, so OpenAI can cache the prompt prefix
+_SYSTEM_PROMPT = SessionEvaluator.ANALYSIS_SYSTEM_PROMPT.format(template=_TEMPLATE_JSON)
+_SYSTEM_PROMPT_HASH = hashlib.sha256(_SYSTEM_PROMPT.encode()).hexdigest()
+_SYSTEM_MESSAGE = {"role": "system", "content": _SYSTEM_PROMPT}
+
+# Structured Outputs format, so the API enforces the template's shape on the extraction.
+# Follow-up questions come last, so the model writes them after working through the template.
+_EXTRACTION_SCHEMA = _template_schema(_TEMPLATE)
+_EXTRACTION_SCHEMA["properties"]["follow_up_questions"] = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+            "score": {"type": "integer"},
+            "rationale": {"type": "string"}
+        },
+        "required": ["question", "score", "rationale"],
+        "additionalProperties": False
+    }
+}
+_EXTRACTION_SCHEMA["required"].append("follow_up_questions")
+
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "person_model",
+        "schema": _EXTRACTION_SCHEMA,
+        "strict": True
+    }
+}
@@ -3,18 +3,21 @@ import os
 from app import app, db
 from models import Conversation, Message, PersonModel
 from openai_assistant import OpenAIAssistant
-from session_evaluator import SessionEvaluator
-import json
+import orjson
 import sys
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Characters of each replayed user message and assistant reply written to the log
+REPLAY_PREVIEW_CHARS = 100
+
 class InterviewTester:
     def __init__(self):
         self.app = app
         self.assistant = OpenAIAssistant()
-        self.evaluator = SessionEvaluator()
+        # The assistant already holds an evaluator, so share it rather than building another
+        self.evaluator = self.assistant.evaluator
 
     def load_test_conversation(self, session_id):
         """Load an existing conversation for testing"""
@@ -23,7 +26,10 @@ class InterviewTester:
             if not conversation:
                 raise ValueError(f"No conversation found with session ID: {session_id}")
 
-            messages = Message.query.filter_by(conversation_id=conversation.id).order_by(Message.created_at).all()
+            # Only role and content are replayed, so skip hydrating full Message objects
+            messages = db.session.query(Message.role, Message.content).filter_by(
+                conversation_id=conversation.id
+            ).order_by(Message.created_at).all()
             logger.info(f"Loaded {len(messages)} messages from conversation {session_id}")
             return conversation, messages
 
@@ -47,16 +53,19 @@ class InterviewTester:
             with self.app.app_context():
                 for i, user_msg in enumerate(user_messages):
                     logger.info(f"Processing message {i+1}/{len(user_messages)}")
-                    logger.info(f"User message: {user_msg.content[:100]}...")
+                    logger.info(f"User message: {user_msg.content[:REPLAY_PREVIEW_CHARS]}...")
 
-                    # Process through assistant
-                    responses = []
+                    # Turns share one assistant thread, which runs them one at a time, so the
+                    # replay stays sequential. The stream is drained rather than cut short because
+                    # the turn is only stored once it finishes; only the logged preview is kept.
+                    preview = []
+                    preview_len = 0
                     for chunk in self.assistant.stream_response(user_msg.content, session_id=test_session_id):
-                        if isinstance(chunk, str):
-                            responses.append(chunk)
+                        if isinstance(chunk, str) and preview_len < REPLAY_PREVIEW_CHARS:
+                            preview.append(chunk)
+                            preview_len += len(chunk)
 
-                    full_response = ''.join(responses)
-                    logger.info(f"Assistant response: {full_response[:100]}...")
+                    logger.info(f"Assistant response: {''.join(preview)[:REPLAY_PREVIEW_CHARS]}...")
 
             logger.info("First interview pass completed. Running evaluation...")
             # Run evaluation to generate follow-up questions
@@ -87,14 +96,14 @@ class InterviewTester:
                     logger.info(f"- Data model size: {len(str(person_model.data_model))} chars")
 
                 # Write test results to a file for reference
-                with open(f'test_results_{test_session_id}.json', 'w') as f:
-                    json.dump({
+                with open(f'test_results_{test_session_id}.json', 'wb') as f:
+                    f.write(orjson.dumps({
                         'test_session_id': test_session_id,
                         'conversation_id': conversation.id,
                         'person_model_id': person_model.id,
                         'follow_up_questions': person_model.follow_up_questions,
                         'missing_topics': person_model.missing_topics,
-                    }, f, indent=2)
+                    }, option=orjson.OPT_INDENT_2))
                 logger.info(f"✅ Test results saved to test_results_{test_session_id}.json")
             else:
                 logger.error(f"Evaluation failed: {evaluation_result['error']}")
@@ -152,20 +161,18 @@ class InterviewTester:
             test_session_id = f"test_no_followup_{os.urandom(4).hex()}"
             logger.info(f"Testing no-followup scenario with session {test_session_id}")
 
-            # Create an empty conversation
+            # Create an empty conversation with a person model that has no follow-ups;
+            # the relationship lets both rows be inserted in one flush and commit
             with self.app.app_context():
-                conversation = Conversation(session_id=test_session_id)
-                db.session.add(conversation)
-                db.session.commit()
-
-                # Create person model with no follow-ups
-                person_model = PersonModel(
-                    conversation_id=conversation.id,
-                    data_model={},
-                    missing_topics=[],
-                    follow_up_questions=[]
+                conversation = Conversation(
+                    session_id=test_session_id,
+                    person_model=PersonModel(
+                        data_model={},
+                        missing_topics=[],
+                        follow_up_questions=[]
+                    )
                 )
-                db.session.add(person_model)
+                db.session.add(conversation)
                 db.session.commit()
 
             # Try to start a second pass
@@ -190,7 +197,6 @@ def load_test_session(test_session_id):
     """Load a test session and prepare it for continuation"""
     try:
         logger.info(f"Loading test session {test_session_id} for continuation")
-        tester = InterviewTester()
 
         with app.app_context():
             # Verify the test session exists
@@ -202,8 +208,8 @@ def load_test_session(test_session_id):
             # Load test results if they exist
             test_results_file = f'test_results_{test_session_id}.json'
             if os.path.exists(test_results_file):
-                with open(test_results_file, 'r') as f:
-                    test_data = json.load(f)
+                with open(test_results_file, 'rb') as f:
+                    test_data = orjson.loads(f.read())
                 logger.info(f"Loaded test data from {test_results_file}")
             else:
                 logger.warning(f"No test results file found for {test_session_id}")
@@ -220,7 +226,7 @@ def load_test_session(test_session_id):
             return {
                 'session_id': test_session_id,
                 'conversation_id': conversation.id,
-                'messages_count': len(conversation.messages),
+                'messages_count': Message.query.filter_by(conversation_id=conversation.id).count(),
                 'has_person_model': bool(person_model),
                 'follow_up_questions': person_model.follow_up_questions if person_model else [],
                 'test_data': test_data
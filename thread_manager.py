@@ -1,46 +1,119 @@
 """Thread management utilities for OpenAI conversation threads."""
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from app import db
+from threading import Lock
+import gevent
+from flask import current_app
+from sqlalchemy import case, update
+from database import db
 from models import SessionThread
+from openai_client import get_openai_client
 
 logger = logging.getLogger(__name__)
 
+# Active thread IDs by session, with when each was last read from the database, so most
+# turns skip the lookup entirely; entries are re-read after the interval in case another
+# worker deactivated the thread
+THREAD_CACHE_SIZE = 1024
+THREAD_REVALIDATE_INTERVAL = timedelta(minutes=1)
+_thread_cache = OrderedDict()
+_thread_cache_lock = Lock()
+
+# Latest activity per session not yet written to last_activity. Touches are written together
+# in one UPDATE at most this many seconds after the first one is recorded.
+TOUCH_FLUSH_DELAY = 30
+_pending_touches = {}
+_touch_flush_scheduled = False
+
+def _cache_thread(session_id, thread_id, validated_at):
+    """Remember a session's active thread, evicting the least recently used beyond the cache size"""
+    with _thread_cache_lock:
+        _thread_cache[session_id] = (thread_id, validated_at)
+        _thread_cache.move_to_end(session_id)
+        if len(_thread_cache) > THREAD_CACHE_SIZE:
+            _thread_cache.popitem(last=False)
+
+def _forget_thread(session_id=None):
+    """Drop a session's cached thread, or every cached thread when no session is given"""
+    with _thread_cache_lock:
+        if session_id is None:
+            _thread_cache.clear()
+        else:
+            _thread_cache.pop(session_id, None)
+
+def _record_touch(session_id, touched_at):
+    """Queue a session's last_activity update, scheduling a flush if none is pending"""
+    global _touch_flush_scheduled
+    with _thread_cache_lock:
+        _pending_touches[session_id] = touched_at
+        if _touch_flush_scheduled:
+            return
+        _touch_flush_scheduled = True
+    gevent.spawn_later(TOUCH_FLUSH_DELAY, _flush_touches_later, current_app._get_current_object())
+
+def _flush_touches_later(app):
+    """Write queued touches in the scheduled greenlet's own app context"""
+    global _touch_flush_scheduled
+    with _thread_cache_lock:
+        _touch_flush_scheduled = False
+    with app.app_context():
+        try:
+            ThreadManager.flush_touches()
+        except Exception:
+            pass  # Logged by flush_touches; the touches are retried with the next flush
+
 class ThreadManager:
     """Manages OpenAI conversation threads."""
     
     @staticmethod
-    def get_or_create_thread(session_id):
-        """Get an existing thread or create a new one for the session."""
+    def get_or_create_thread(session_id, seed_messages=None):
+        """Get an existing thread or create a new one for the session.
+
+        seed_messages is an optional callable returning the messages a newly
+        created thread should start with; it is not called for existing threads.
+        """
+        now = datetime.utcnow()
+        with _thread_cache_lock:
+            cached = _thread_cache.get(session_id)
+            if cached:
+                _thread_cache.move_to_end(session_id)
+        if cached and now - cached[1] < THREAD_REVALIDATE_INTERVAL:
+            _record_touch(session_id, now)
+            return cached[0]
+
         try:
-            # Check for existing active thread
-            thread = SessionThread.query.filter_by(
-                session_id=session_id,
-                is_active=True
-            ).first()
+            # Session IDs are unique, so an inactive row is reused for the new thread
+            thread = SessionThread.query.filter_by(session_id=session_id).first()
             
-            if thread:
-                # Update last activity
-                thread.touch()
-                db.session.commit()
+            if thread and thread.is_active:
+                # Update last activity with the next batch of touches rather than committing now
+                _record_touch(session_id, now)
+                _cache_thread(session_id, thread.thread_id, now)
                 logger.info(f"Retrieved existing thread for session {session_id}")
                 return thread.thread_id
             
-            # Create new thread
-            from openai import OpenAI
-            client = OpenAI()
-            response = client.beta.threads.create()
+            # Create new thread on the shared client, reusing its pooled connections
+            client = get_openai_client()
+            messages = seed_messages() if seed_messages else []
+            response = client.beta.threads.create(messages=messages) if messages else client.beta.threads.create()
             thread_id = response.id
             
             # Store new thread
-            thread = SessionThread(
-                session_id=session_id,
-                thread_id=thread_id
-            )
-            db.session.add(thread)
+            if thread:
+                thread.thread_id = thread_id
+                thread.is_active = True
+                thread.touch()
+            else:
+                thread = SessionThread(
+                    session_id=session_id,
+                    thread_id=thread_id
+                )
+                db.session.add(thread)
             db.session.commit()
+            _cache_thread(session_id, thread_id, now)
             
-            logger.info(f"Created new thread for session {session_id}")
+            logger.info(f"Created new thread for session {session_id} with {len(messages)} seed messages")
             return thread_id
             
         except Exception as e:
@@ -48,25 +121,69 @@ class ThreadManager:
             db.session.rollback()
             raise
     
+    @staticmethod
+    def flush_touches():
+        """Write every queued last_activity update in a single UPDATE, returning the number written"""
+        with _thread_cache_lock:
+            touches = dict(_pending_touches)
+            _pending_touches.clear()
+        if not touches:
+            return 0
+
+        try:
+            db.session.execute(
+                update(SessionThread)
+                .where(SessionThread.session_id.in_(list(touches)))
+                .values(
+                    last_activity=case(touches, value=SessionThread.session_id),
+                    updated_at=datetime.utcnow()
+                )
+            )
+            db.session.commit()
+            return len(touches)
+        except Exception as e:
+            logger.error(f"Error flushing thread activity: {str(e)}")
+            db.session.rollback()
+            # Requeue the touches unless the session has been touched again since
+            with _thread_cache_lock:
+                for session_id, touched_at in touches.items():
+                    _pending_touches.setdefault(session_id, touched_at)
+            raise
+
+    @staticmethod
+    def deactivate_thread(session_id):
+        """Mark a session's thread as inactive so the next request creates a new one."""
+        _forget_thread(session_id)
+        try:
+            thread = SessionThread.query.filter_by(session_id=session_id).first()
+            if thread:
+                thread.is_active = False
+                db.session.commit()
+                logger.info(f"Marked thread {thread.thread_id} as inactive for session {session_id}")
+        except Exception as e:
+            logger.error(f"Error deactivating thread for session {session_id}: {str(e)}")
+            db.session.rollback()
+            raise
+    
     @staticmethod
     def cleanup_inactive_threads(max_age_hours=24):
         """Clean up threads that have been inactive for the specified period."""
         try:
+            # Queued touches may keep recently used threads out of the cutoff
+            ThreadManager.flush_touches()
             cutoff_time = datetime.utcnow() - timedelta(hours=max_age_hours)
             
-            # Find inactive threads
-            inactive_threads = SessionThread.query.filter(
-                SessionThread.last_activity < cutoff_time,
-                SessionThread.is_active == True
-            ).all()
-            
-            # Mark threads as inactive
-            for thread in inactive_threads:
-                thread.is_active = False
-                logger.info(f"Marking thread {thread.thread_id} as inactive due to age")
-            
+            # Mark stale threads inactive in one statement rather than loading each row
+            result = db.session.execute(
+                update(SessionThread)
+                .where(SessionThread.last_activity < cutoff_time, SessionThread.is_active.is_(True))
+                .values(is_active=False)
+            )
             db.session.commit()
-            return len(inactive_threads)
+            # Any of the deactivated threads may be cached
+            _forget_thread()
+            logger.info(f"Marked {result.rowcount} threads as inactive due to age")
+            return result.rowcount
             
         except Exception as e:
             logger.error(f"Error cleaning up inactive threads: {str(e)}")
@@ -83,6 +200,7 @@ class ThreadManager:
         return {
             'thread_id': thread.thread_id,
             'created_at': thread.created_at,
-            'last_activity': thread.last_activity,
+            # A queued touch is newer than what has been written so far
+            'last_activity': _pending_touches.get(session_id, thread.last_activity),
             'is_active': thread.is_active
         }
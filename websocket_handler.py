@@ -1,12 +1,67 @@
-import json
 import logging
+import socket
+import time
+from datetime import datetime
 import gevent
+from gevent.event import Event
+from gevent.queue import Queue
+import orjson
 from database import db
-from models import Conversation, Message
+from models import Conversation, store_messages
 from openai_assistant import OpenAIAssistant
 
 logger = logging.getLogger(__name__)
 
+# Streamed chunks are coalesced into one frame until this much text is pending or this many
+# seconds have passed since the last frame; the first chunk of a response goes out at once
+STREAM_FLUSH_CHARS = 16 * 1024
+STREAM_FLUSH_INTERVAL = 0.02
+
+# Frames waiting for the sender greenlet; a slow client eventually blocks the stream here
+SEND_QUEUE_SIZE = 64
+
+# Streamed chunks between checks for a closed socket or a failed send
+CLOSED_CHECK_INTERVAL = 16
+
+# Frames that never change, encoded once. gevent-websocket sends text frames from str and
+# would send the repr of bytes, so every frame is decoded before it goes out
+_DONE_FRAME = orjson.dumps({"chunk": "", "done": True}).decode()
+_MESSAGE_REQUIRED_FRAME = orjson.dumps({"error": "Message field is required"}).decode()
+_INVALID_JSON_FRAME = orjson.dumps({"error": "Invalid JSON message"}).decode()
+_INTERNAL_ERROR_FRAME = orjson.dumps({"error": "Internal server error"}).decode()
+
+# send_frame silently drops an empty payload, so keepalive pings need a non-empty one
+_PING_PAYLOAD = 'keepalive'
+
+# Streamed chunk frames differ only in the chunk text, so the envelope is spliced around it
+_CHUNK_PREFIX = '{"chunk":'
+_CHUNK_SUFFIX = ',"done":false}'
+_FINAL_CHUNK_SUFFIX = ',"done":true}'
+
+def _send_json(ws, payload):
+    """Send a payload as a JSON text frame"""
+    ws.send(orjson.dumps(payload).decode())
+
+def _chunk_frame(chunk, done=False):
+    """Build a streamed chunk frame, encoding only the chunk string itself"""
+    return _CHUNK_PREFIX + orjson.dumps(chunk).decode() + (_FINAL_CHUNK_SUFFIX if done else _CHUNK_SUFFIX)
+
+def _send_frames(ws, frames, failed):
+    """Send queued frames until the queue ends, returning the first send error if any.
+
+    A failed send sets the failed event, and frames queued after it are discarded so
+    the producer never blocks.
+    """
+    error = None
+    for frame in frames:
+        if error is None:
+            try:
+                ws.send(frame)
+            except Exception as e:
+                error = e
+                failed.set()
+    return error
+
 def handle_websocket(ws):
     """Handle WebSocket connections and messages."""
     try:
@@ -17,17 +72,23 @@ def handle_websocket(ws):
         logger.info("Initializing new WebSocket connection")
         assistant = OpenAIAssistant()
 
+        # This session only writes, so reloading expired objects after every commit is wasted
+        # work; the setting lasts as long as the connection's app context
+        db.session().expire_on_commit = False
+
         # Create a new conversation for this WebSocket connection
         conversation = Conversation()
         db.session.add(conversation)
         db.session.commit()
-        logger.info(f"Created new conversation with ID: {conversation.id}")
+        # Kept as a plain int so turns skip the instrumented attribute
+        conversation_id = conversation.id
+        logger.info(f"Created new conversation with ID: {conversation_id}")
 
         # Start ping-pong to keep connection alive
         def ping():
             while not ws.closed:
                 try:
-                    ws.send_frame('', ws.OPCODE_PING)
+                    ws.send_frame(_PING_PAYLOAD, ws.OPCODE_PING)
                     gevent.sleep(15)  # Send ping every 15 seconds
                 except Exception as e:
                     logger.error(f"Error sending ping: {e}")
@@ -37,85 +98,94 @@ def handle_websocket(ws):
 
         while not ws.closed:
             try:
-                # Set a longer timeout for receiving messages
-                message = ws.receive(timeout=30)
+                # receive() takes no timeout of its own, so wait at most 30 seconds for a message
+                with gevent.Timeout(30):
+                    message = ws.receive()
 
                 if message is None:
                     logger.debug("Received heartbeat/ping")
                     continue
 
                 try:
-                    data = json.loads(message)
+                    data = orjson.loads(message)
                     user_message = data.get('message')
 
                     if not user_message:
                         logger.warning("Received message without content")
-                        ws.send(json.dumps({
-                            "error": "Message field is required"
-                        }))
+                        ws.send(_MESSAGE_REQUIRED_FRAME)
                         continue
 
-                    logger.info(f"Processing user message: {user_message[:50]}...")
+                    # Lazy %-formatting: the preview is only built if INFO records are emitted
+                    logger.info("Processing user message: %.50s...", user_message)
 
-                    # Store user message in database
-                    db_message = Message(
-                        conversation_id=conversation.id,
-                        role='user',
-                        content=user_message
-                    )
-                    db.session.add(db_message)
-                    db.session.commit()
+                    # The user message is stored together with the response in one commit,
+                    # timestamped now so it still sorts before the response
+                    turn_messages = [('user', user_message, datetime.utcnow())]
 
                     # Stream the response from OpenAI
+                    response_parts = []
                     full_response = ""
-                    for response_chunk in assistant.stream_response(user_message):
-                        if ws.closed:
-                            logger.warning("WebSocket closed during response streaming")
-                            break
-                        full_response += response_chunk
-                        ws.send(json.dumps({
-                            "chunk": response_chunk,
-                            "done": False
-                        }))
-
-                    if not ws.closed and full_response:
-                        # Store assistant's response in database
-                        assistant_message = Message(
-                            conversation_id=conversation.id,
-                            role='assistant',
-                            content=full_response.strip()
-                        )
-                        db.session.add(assistant_message)
-                        db.session.commit()
-
-                        # Send completion message
-                        ws.send(json.dumps({
-                            "chunk": "",
-                            "done": True
-                        }))
-
-                except json.JSONDecodeError as e:
+                    pending = []
+                    pending_chars = 0
+                    last_flush = 0.0
+                    # A separate greenlet writes frames so sending overlaps waiting on the next token
+                    frames = Queue(SEND_QUEUE_SIZE)
+                    send_failed = Event()
+                    sender = gevent.spawn(_send_frames, ws, frames, send_failed)
+                    try:
+                        for i, response_chunk in enumerate(assistant.stream_response(user_message)):
+                            # A closed socket also fails the next send, so polling now and then is enough
+                            if not i % CLOSED_CHECK_INTERVAL and (ws.closed or send_failed.is_set()):
+                                logger.warning("WebSocket closed during response streaming")
+                                break
+                            response_parts.append(response_chunk)
+                            pending.append(response_chunk)
+                            pending_chars += len(response_chunk)
+
+                            now = time.monotonic()
+                            if pending_chars >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL:
+                                frames.put(_chunk_frame("".join(pending)))
+                                pending = []
+                                pending_chars = 0
+                                last_flush = now
+
+                        # The last text is held back and sent with the done flag
+                        final_text = "".join(pending)
+
+                        full_response = "".join(response_parts)
+                        if not ws.closed and full_response:
+                            # Send completion message, carrying any remaining text rather than in a frame
+                            # of its own, ahead of the store so the client isn't kept waiting on the commit
+                            frames.put(_chunk_frame(final_text, done=True) if final_text else _DONE_FRAME)
+                            turn_messages.append(('assistant', full_response.strip(), datetime.utcnow()))
+                    finally:
+                        # Let queued frames go out before the turn completes
+                        frames.put(StopIteration)
+                        send_error = sender.get()
+                        # Keep the user message even when streaming fails
+                        store_messages(conversation_id, turn_messages)
+
+                    if send_error:
+                        raise send_error
+
+                except orjson.JSONDecodeError as e:
                     logger.error(f"Invalid JSON message: {str(e)}")
                     if not ws.closed:
-                        ws.send(json.dumps({
-                            "error": "Invalid JSON message"
-                        }))
+                        ws.send(_INVALID_JSON_FRAME)
                 except Exception as e:
                     logger.error(f"Error processing message: {str(e)}")
                     if not ws.closed:
-                        ws.send(json.dumps({
+                        _send_json(ws, {
                             "error": f"Error processing message: {str(e)}"
-                        }))
+                        })
 
+            except (gevent.Timeout, socket.timeout):
+                continue  # No message within the receive timeout; the ping greenlet keeps the connection open
             except Exception as e:
-                if "timed out" in str(e).lower():
-                    continue  # This is normal for ping/pong
                 logger.error(f"Error in message loop: {str(e)}")
                 if not ws.closed:
                     try:
-                        ws.send(json.dumps({
-                            "error": "Internal server error"
-                        }))
+                        ws.send(_INTERNAL_ERROR_FRAME)
                     except:
                         pass
                 break